@@ -1,9 +1,29 @@
 import os
+import atexit
 import logging
+import logging.handlers
 import requests
+from urllib.parse import urlsplit
 import re
+import json
+import string
+import functools
+import time
+import warnings
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import MutableMapping
+import orjson
+import redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
+from markupsafe import escape
 from telegram import Update, Bot
+from telegram.utils.request import Request
+from telegram.error import TelegramError
 from telegram.ext import (
     CommandHandler,
     MessageHandler,
@@ -11,9 +31,11 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
     Dispatcher,
+    BasePersistence,
 )
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google.auth.exceptions import GoogleAuthError, RefreshError
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
 
 # --- CONFIGURATION (from Environment Variables) ---
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
@@ -27,138 +49,473 @@ IMAGEBB_API_KEY = os.environ.get("IMAGEBB_API_KEY")
 TELEGRAM_CHANNEL_LINK = os.environ.get("TELEGRAM_CHANNEL_LINK")
 INSTAGRAM_LINK = os.environ.get("INSTAGRAM_LINK")
 SOURCE_CHANNEL_IDS_STR = os.environ.get("SOURCE_CHANNEL_IDS", "")
-SOURCE_CHANNEL_IDS = [int(channel_id.strip()) for channel_id in SOURCE_CHANNEL_IDS_STR.split(',') if channel_id.strip()]
+SOURCE_CHANNEL_IDS = frozenset(int(channel_id.strip()) for channel_id in SOURCE_CHANNEL_IDS_STR.split(',') if channel_id.strip())
+# Users allowed to manage the domain list; empty keeps the commands open to everyone.
+ADMIN_IDS = frozenset(int(user_id.strip()) for user_id in os.environ.get("ADMIN_IDS", "").split(',') if user_id.strip())
+SET_WEBHOOK_ON_START = os.environ.get("SET_WEBHOOK_ON_START") == "1"
+# Polling has to delete the registered webhook, so it is only done with an explicit opt-in.
+DELETE_WEBHOOK_FOR_POLLING = os.environ.get("DELETE_WEBHOOK_FOR_POLLING") == "1"
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 86400))
+IMAGEBB_CONCURRENCY = int(os.environ.get("IMAGEBB_CONCURRENCY", 2))
+HTTP_TIMEOUT = (5, 30)  # (connect, read) seconds for ImageBB and Blogger calls
+IMAGE_UPLOAD_TIMEOUT = int(os.environ.get("IMAGE_UPLOAD_TIMEOUT", 120))  # seconds a publish waits for its image
+PUBLISH_WORKERS = int(os.environ.get("PUBLISH_WORKERS", 4))
+MIN_IMAGE_SIDE = int(os.environ.get("MIN_IMAGE_SIDE", 1280))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+PORT = int(os.environ.get('PORT', 8000))
 
 # --- NEW: Domain Management ---
 DOMAINS_FILE = "allowed_domains.txt"
 DEFAULT_DOMAINS_STR = "tinyurl.com,terabox.com,mirrobox.com,nephobox.com,freeterabox.com,1024tera.com,4funbox.co,terabox.app,momerybox.com,teraboxapp.com,tibibox.com,terasharelink.com,teraboxurl.com"
 
+# Adds and removals are appended to a journal ("+ domain" / "- domain") instead of
+# rewriting the whole list; the journal is replayed on startup and folded back into
+# DOMAINS_FILE every JOURNAL_COMPACT_EVERY changes. Startup only reads, since every
+# gunicorn worker imports this module at once.
+DOMAINS_JOURNAL = "allowed_domains.journal"
+JOURNAL_COMPACT_EVERY = 100
+journal_ops = 0
+
 # --- NEW: Functions to load and save domains ---
+def normalize_domain(value):
+    # Links are matched on hostname, so entries typed as a URL ("https://foo.com/x") or
+    # with a www. prefix are reduced to the bare host; returns None if there is none.
+    value = value.strip().lower()
+    try:
+        host = urlsplit(value if '//' in value else '//' + value).hostname
+    except ValueError:
+        return None
+    return host.removeprefix('www.') if host else None
+
 def load_domains():
     if os.path.exists(DOMAINS_FILE):
         with open(DOMAINS_FILE, "r") as f:
-            return {line.strip() for line in f if line.strip()}
+            # Older lists may hold entries typed as URLs; they are normalised so they still match.
+            domains = {normalize_domain(line) or line.strip() for line in f if line.strip()}
     else:
-        default_domains = {domain.strip() for domain in DEFAULT_DOMAINS_STR.split(',') if domain.strip()}
-        save_domains(default_domains)
-        return default_domains
+        domains = {domain.strip() for domain in DEFAULT_DOMAINS_STR.split(',') if domain.strip()}
+        save_domains(domains)
+    global journal_ops
+    if os.path.exists(DOMAINS_JOURNAL):
+        with open(DOMAINS_JOURNAL, "r") as f:
+            for line in f:
+                op, _, domain = line.strip().partition(' ')
+                domain = normalize_domain(domain) or domain
+                if op == '+':
+                    domains.add(domain)
+                elif op == '-':
+                    domains.discard(domain)
+                journal_ops += 1
+    return domains
 
 def save_domains(domains_set):
-    with open(DOMAINS_FILE, "w") as f:
-        for domain in sorted(list(domains_set)):
-            f.write(f"{domain}\n")
+    # Written to a temp file and swapped in, so a crash mid-write never leaves a truncated list.
+    # The temp name is per process so concurrent writers never swap in each other's file.
+    tmp_path = f"{DOMAINS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("".join(f"{domain}\n" for domain in sorted(domains_set)))
+    os.replace(tmp_path, DOMAINS_FILE)
+
+def compact_domains(domains_set):
+    global journal_ops
+    save_domains(domains_set)
+    try:
+        os.remove(DOMAINS_JOURNAL)
+    except FileNotFoundError:
+        pass
+    journal_ops = 0
+
+def journal_domain_change(op, domain):
+    global journal_ops
+    with open(DOMAINS_JOURNAL, "a") as f:
+        f.write(f"{op} {domain}\n")
+    journal_ops += 1
+    if journal_ops >= JOURNAL_COMPACT_EVERY:
+        compact_domains(VALID_LINK_DOMAINS)
 
 # Load domains on startup
 VALID_LINK_DOMAINS = load_domains()
 
+# Links are matched on their hostname (or a parent domain of it), not by substring,
+# so e.g. https://evil.example/?terabox.com is no longer accepted.
+ALLOWED_DOMAINS = frozenset(VALID_LINK_DOMAINS)
+# Pre-rendered for the "post ignored" log line, which can fire on every channel post.
+ALLOWED_DOMAINS_TEXT = ", ".join(sorted(VALID_LINK_DOMAINS))
+
+def is_allowed_link(url):
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return False
+    return bool(host) and is_allowed_host(host, ALLOWED_DOMAINS)
+
+# Channels keep reposting the same few hosts, so the suffix walk is cached per host.
+# The domain set is part of the key, so a domain list change can never be answered
+# from a stale entry, even by a lookup racing the change on another thread.
+@functools.lru_cache(maxsize=256)
+def is_allowed_host(host, allowed_domains):
+    while host:
+        if host in allowed_domains:
+            return True
+        host = host.partition('.')[2]
+    return False
+
+def domains_changed(op, domain):
+    global ALLOWED_DOMAINS, ALLOWED_DOMAINS_TEXT
+    journal_domain_change(op, domain)
+    ALLOWED_DOMAINS = frozenset(VALID_LINK_DOMAINS)
+    ALLOWED_DOMAINS_TEXT = ", ".join(sorted(VALID_LINK_DOMAINS))
+
+# --- Precompiled patterns and static HTML, built once at import ---
+URL_RE = re.compile(r'https?://\S+')
+NEWLINE_RE = re.compile(r'\r\n?|\n')
+# One pass over a channel caption finds its links and where the caption text ends:
+# at the first link or promo/credit marker, whichever comes first.
+CAPTION_RE = re.compile(r'(?P<url>https?://\S+)|Full Video|\(BY - @|👉|Watch Online', re.IGNORECASE)
+STYLE_BLOCK = """<style>.post-container{text-align:center;font-family:sans-serif}.post-container img{max-width:100%;height:auto;border-radius:12px;margin-bottom:20px}.post-caption{font-size:1.1em;color:#444;line-height:1.6;padding:0 10px;margin-bottom:25px}.button-container{margin-bottom:30px}.video-button,.social-button{display:inline-block;padding:12px 28px;margin:8px;font-size:16px;font-weight:bold;color:#fff;border:none;border-radius:8px;text-decoration:none;transition:transform .2s}.video-button:hover,.social-button:hover{transform:scale(1.05)}.video-button{background-color:#ff4500}.social-button.telegram{background-color:#0088cc}.social-button.instagram{background:#d6249f;background:radial-gradient(circle at 30% 107%,#fdf497 0,#fdf497 5%,#fd5949 45%,#d6249f 60%,#285aeb 90%)}</style>"""
+# The footer depends only on env config, so it is rendered once and baked into the template.
+FOOTER_HTML = "".join(
+    f'<a href="{escape(link)}" class="social-button {css_class}" target="_blank">{label}</a>'
+    for link, css_class, label in (
+        (TELEGRAM_CHANNEL_LINK, "telegram", "Join All Channels"),
+        (INSTAGRAM_LINK, "instagram", "Follow on Instagram"),
+    )
+    if link
+)
+POST_BODY_HTML = (
+    '<div class="post-caption">$caption</div><div class="button-container">$buttons</div>'
+    '<div class="footer-container">' + FOOTER_HTML.replace('$', '$$') + '</div></div>'
+)
+# Posts whose image upload failed use the variant without an <img>, rather than an empty src.
+POST_TEMPLATE = string.Template(STYLE_BLOCK + '<div class="post-container"><img src="$image_url" />' + POST_BODY_HTML)
+POST_TEMPLATE_NO_IMAGE = string.Template(STYLE_BLOCK + '<div class="post-container">' + POST_BODY_HTML)
+
 
 # Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Records go through a queue and are written by a QueueListener thread, so request
+# and worker threads never block on log I/O.
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_record_queue = queue.SimpleQueue()
+# The QueueHandler has no formatter of its own (it falls back to the bare message), so
+# only the listener's format is applied, once, on the listener thread.
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_record_queue))
+log_listener = logging.handlers.QueueListener(log_record_queue, log_handler)
+log_listener.start()
+# Stopping the listener drains whatever is still queued, so lines logged just before exit aren't lost.
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=TELEGRAM_TOKEN)
+# The Bot API is called concurrently by each publish worker (replies), each io worker
+# (file downloads), the dispatcher, the log sender and, in local runs, the polling loop,
+# so the bot's connection pool is sized to match instead of PTB's default of 1.
+bot = Bot(token=TELEGRAM_TOKEN, request=Request(con_pool_size=PUBLISH_WORKERS * 2 + 3))
+
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+# Shared keep-alive session for ImageBB, so uploads reuse pooled TLS connections.
+# Rate-limit and gateway errors are retried with short backoff. Retry-After is ignored:
+# it can ask for hours, and the upload holds an imagebb_slots slot while it sleeps.
+imagebb_session = requests.Session()
+imagebb_session.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504], allowed_methods=frozenset(["POST"]),
+                      respect_retry_after_header=False),
+))
+# ImageBB rate-limits per API key, so cap simultaneous uploads across all workers in this process.
+imagebb_slots = threading.BoundedSemaphore(IMAGEBB_CONCURRENCY)
+
+class BoundedCache:
+    """Thread-safe LRU mapping that forgets the least recently used keys first."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def add(self, key) -> bool:
+        """Remember key; returns False if it was already known."""
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return False
+            self.items[key] = None
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+            return True
 
 # --- HELPER FUNCTIONS (Original Code) ---
+LOG_FLUSH_INTERVAL = 2
+LOG_SEND_INTERVAL = 1  # Telegram allows about one message per second into a channel
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Bounded so an unreachable log channel can't grow memory without limit; the oldest lines go first.
+log_buffer = deque(maxlen=1000)
+log_pending = threading.Event()
+
 def send_log(message: str):
+    # Buffered and sent in batches by log_worker, so handlers never wait on the Bot API.
     if LOG_CHANNEL_ID:
-        try: bot.send_message(chat_id=LOG_CHANNEL_ID, text=message)
-        except Exception as e: logger.error(f"Failed to send log message: {e}")
+        if len(log_buffer) == log_buffer.maxlen:
+            logger.warning("Log channel buffer full, dropping the oldest message")
+        log_buffer.append(message)
+        log_pending.set()
+
+def log_worker():
+    while True:
+        log_pending.wait()
+        time.sleep(LOG_FLUSH_INTERVAL)
+        log_pending.clear()
+        lines = []
+        while log_buffer:
+            lines.append(log_buffer.popleft())
+        # A line appended after clear() may already have been drained above, leaving a wake-up with nothing to send.
+        if not lines:
+            continue
+        batch = ""
+        for line in lines:
+            line = line[:TELEGRAM_MESSAGE_LIMIT]
+            if batch and len(batch) + 1 + len(line) > TELEGRAM_MESSAGE_LIMIT:
+                flush_log_batch(batch)
+                time.sleep(LOG_SEND_INTERVAL)
+                batch = ""
+            batch = f"{batch}\n{line}" if batch else line
+        flush_log_batch(batch)
+
+def flush_log_batch(text: str):
+    try: bot.send_message(chat_id=LOG_CHANNEL_ID, text=text)
+    except Exception as e: logger.error("Failed to send log message: %s", e)
 
-def get_blogger_service():
+threading.Thread(target=log_worker, daemon=True).start()
+
+# Blogger is called through its REST endpoint on one shared AuthorizedSession
+# (google-auth over requests), so there is no discovery document and the HTTPS
+# connection is kept alive between posts. The access token is refreshed here
+# rather than lazily on insert, so the refresh can overlap with the ImageBB upload.
+BLOGGER_POSTS_URL = f"https://www.googleapis.com/blogger/v3/blogs/{BLOG_ID}/posts"
+# Only the post id is needed back; don't have Blogger echo the whole HTML body.
+BLOGGER_INSERT_PARAMS = {"isDraft": "false", "fetchBody": "false", "fields": "id"}
+blogger_auth_request = GoogleAuthRequest()
+_blogger_session = None
+_blogger_session_lock = threading.Lock()
+
+def get_blogger_session():
+    global _blogger_session
+    with _blogger_session_lock:
+        if _blogger_session is None:
+            try:
+                creds = Credentials(
+                    token=None, refresh_token=GOOGLE_REFRESH_TOKEN, token_uri="https://oauth2.googleapis.com/token",
+                    client_id=GOOGLE_CLIENT_ID, client_secret=GOOGLE_CLIENT_SECRET, scopes=['https://www.googleapis.com/auth/blogger']
+                )
+                _blogger_session = AuthorizedSession(creds, auth_request=blogger_auth_request)
+                # One kept-alive connection per publish worker; inserts are not retried
+                # automatically since a retried POST could publish the post twice.
+                _blogger_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=PUBLISH_WORKERS))
+                # Google APIs only gzip responses when the User-Agent also contains "gzip".
+                _blogger_session.headers["User-Agent"] = f"poster-bot {requests.utils.default_user_agent()} (gzip)"
+            except Exception as e:
+                logger.error("Failed to create Google session: %s", e)
+                return None
+        if not _blogger_session.credentials.valid:
+            try:
+                _blogger_session.credentials.refresh(blogger_auth_request)
+            except RefreshError:
+                # Start over with fresh credentials on the next call instead of reusing a broken session.
+                _blogger_session = None
+                raise
+        return _blogger_session
+
+def pick_photo_size(photos):
+    # ImageBB re-encodes anyway, so fetch the smallest size that is still big enough for the post.
+    large_enough = [p for p in photos if max(p.width, p.height) >= MIN_IMAGE_SIDE]
+    return min(large_enough, key=lambda p: p.width * p.height) if large_enough else photos[-1]
+
+def upload_to_imagebb(image_bytes):
+    if not IMAGEBB_API_KEY or not image_bytes:
+        return None
+    upload_url = "https://api.imgbb.com/1/upload"
+    # The image bytes are sent rather than ImageBB's image=<url> form: Telegram file URLs
+    # embed the bot token, and handing one to a third party would leak it.
+    payload = {"key": IMAGEBB_API_KEY}
+    files = {"image": ("image.jpg", image_bytes)}
     try:
-        creds = Credentials(
-            token=None, refresh_token=GOOGLE_REFRESH_TOKEN, token_uri="https://oauth2.googleapis.com/token",
-            client_id=GOOGLE_CLIENT_ID, client_secret=GOOGLE_CLIENT_SECRET, scopes=['https://www.googleapis.com/auth/blogger']
-        )
-        service = build('blogger', 'v3', credentials=creds)
-        return service
-    except Exception as e:
-        logger.error(f"Failed to build Google service: {e}")
+        with imagebb_slots:
+            response = imagebb_session.post(upload_url, params=payload, files=files, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        json_response = orjson.loads(response.content)
+        return json_response["data"]["url"] if json_response.get("success") else None
+    except (requests.RequestException, orjson.JSONDecodeError) as e:
+        logger.error("ImageBB upload failed: %s", e)
         return None
 
-def upload_to_imagebb(image_path):
-    if not IMAGEBB_API_KEY:
+def build_blog_post_html(image_url, caption_text, links_list):
+    # Captions and links come straight from Telegram users, so escape them before they reach the page.
+    if len(links_list) == 1:
+        dynamic_buttons_html = f'<a href="{escape(links_list[0])}" class="video-button" target="_blank">🎬 Watch Video</a>'
+    else:
+        dynamic_buttons_html = "".join(
+            f'<a href="{escape(url)}" class="video-button" target="_blank">🎬 Watch Video {i + 1}</a>' for i, url in enumerate(links_list)
+        )
+    caption_html = NEWLINE_RE.sub("<br>", str(escape(caption_text)))
+    if not image_url:
+        return POST_TEMPLATE_NO_IMAGE.substitute(caption=caption_html, buttons=dynamic_buttons_html)
+    return POST_TEMPLATE.substitute(image_url=escape(image_url), caption=caption_html, buttons=dynamic_buttons_html)
+
+# Handlers only parse the update and queue a publish job here; the slow Telegram
+# download, ImageBB upload and Blogger insert all run on these workers.
+publish_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="publish")
+# Each publish runs at most one task (its image upload) here, so one thread per publish worker.
+io_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="io")
+
+# Create the Blogger session and fetch its first access token in the background at
+# startup, so the first publish after a restart doesn't wait for the OAuth refresh.
+if GOOGLE_REFRESH_TOKEN:
+    io_executor.submit(get_blogger_session)
+
+# ImageBB URLs by Telegram file_unique_id, so a retried or re-posted image isn't uploaded twice.
+imagebb_urls = BoundedCache(1024)
+
+def upload_telegram_file(file_id, file_unique_id=None):
+    if not file_id or not IMAGEBB_API_KEY:
         return None
-    upload_url = "https://api.imgbb.com/1/upload"
-    with open(image_path, "rb") as image_file:
-        payload = {"key": IMAGEBB_API_KEY}
-        files = {"image": image_file}
+    image_url = imagebb_urls.get(file_unique_id) if file_unique_id else None
+    if image_url is None:
         try:
-            response = requests.post(upload_url, params=payload, files=files)
-            response.raise_for_status()
-            json_response = response.json()
-            return json_response["data"]["url"] if json_response.get("success") else None
-        except requests.RequestException as e:
-            logger.error(f"ImageBB upload failed: {e}")
+            image_bytes = bot.get_file(file_id).download_as_bytearray()
+        except TelegramError as e:
+            logger.error("Telegram file download failed: %s", e)
             return None
+        image_url = upload_to_imagebb(image_bytes)
+        if image_url and file_unique_id:
+            imagebb_urls.set(file_unique_id, image_url)
+    return image_url
 
-def build_blog_post_html(image_url, caption_text, links_list):
-    dynamic_buttons_html = ""
-    if len(links_list) == 1:
-        dynamic_buttons_html = f'<a href="{links_list[0]}" class="video-button" target="_blank">🎬 Watch Video</a>'
-    elif len(links_list) > 1:
-        for i, url in enumerate(links_list):
-            dynamic_buttons_html += f'<a href="{url}" class="video-button" target="_blank">🎬 Watch Video {i + 1}</a>'
-    footer_buttons_html = ""
-    if TELEGRAM_CHANNEL_LINK:
-        footer_buttons_html += f'<a href="{TELEGRAM_CHANNEL_LINK}" class="social-button telegram" target="_blank">Join All Channels</a>'
-    if INSTAGRAM_LINK:
-        footer_buttons_html += f'<a href="{INSTAGRAM_LINK}" class="social-button instagram" target="_blank">Follow on Instagram</a>'
-    style_block = """<style>.post-container{text-align:center;font-family:sans-serif}.post-container img{max-width:100%;height:auto;border-radius:12px;margin-bottom:20px}.post-caption{font-size:1.1em;color:#444;line-height:1.6;padding:0 10px;margin-bottom:25px}.button-container{margin-bottom:30px}.video-button,.social-button{display:inline-block;padding:12px 28px;margin:8px;font-size:16px;font-weight:bold;color:#fff;border:none;border-radius:8px;text-decoration:none;transition:transform .2s}.video-button:hover,.social-button:hover{transform:scale(1.05)}.video-button{background-color:#ff4500}.social-button.telegram{background-color:#0088cc}.social-button.instagram{background:#d6249f;background:radial-gradient(circle at 30% 107%,#fdf497 0,#fdf497 5%,#fd5949 45%,#d6249f 60%,#285aeb 90%)}</style>"""
-    return f"""{style_block}<div class="post-container"><img src="{image_url if image_url else ''}" /><div class="post-caption">{caption_text.replace(os.linesep, "<br>")}</div><div class="button-container">{dynamic_buttons_html}</div><div class="footer-container">{footer_buttons_html}</div></div>"""
-
-def process_and_publish_post(context: CallbackContext, title: str, caption_text: str, photo_path: str, links_list: list, user_name: str, source: str):
+def process_and_publish_post(title: str, caption_text: str, file_id: str, links_list: list, user_name: str, source: str, chat_id=None, file_unique_id=None):
+    # The image download/upload and the Google token refresh don't depend on each other, so run them together.
+    image_url_future = io_executor.submit(upload_telegram_file, file_id, file_unique_id)
     try:
-        service = get_blogger_service()
-        if not service:
-            send_log(f"❌ {source.upper()} ERROR! Could not build Google Blogger service.")
-            if source == 'manual': context.bot.send_message(chat_id=context.user_data['chat_id'], text="Error: Could not connect to Google.")
-            return
-        image_url = upload_to_imagebb(photo_path)
-        body_html = build_blog_post_html(image_url, caption_text, links_list)
-        body = {"kind": "blogger#post", "blog": {"id": BLOG_ID}, "title": title, "content": body_html}
-        posts = service.posts()
-        posts.insert(blogId=BLOG_ID, body=body, isDraft=False).execute()
-        send_log(f"✅ {source.upper()} SUCCESS! Post '{title}' published by {user_name}.")
-        if source == 'manual': context.bot.send_message(chat_id=context.user_data['chat_id'], text=f"Success! Post '{title}' published.")
-    except Exception as e:
+        session = get_blogger_session()
+    except GoogleAuthError:
+        # RefreshError for a rejected token, TransportError when the token endpoint is unreachable.
+        logger.exception("Google token refresh failed")
+        session = None
+    if not session:
+        send_log(f"❌ {source.upper()} ERROR! Could not create Google Blogger session.")
+        if chat_id: bot.send_message(chat_id=chat_id, text="Error: Could not connect to Google.")
+        return
+    # A failed or slow image upload yields None and the post goes out without an image.
+    try:
+        image_url = image_url_future.result(timeout=IMAGE_UPLOAD_TIMEOUT)
+    except FutureTimeoutError:
+        logger.error("Image upload for '%s' timed out, publishing without an image", title)
+        image_url = None
+    body_html = build_blog_post_html(image_url, caption_text, links_list)
+    body = {"kind": "blogger#post", "blog": {"id": BLOG_ID}, "title": title, "content": body_html}
+    try:
+        response = session.post(BLOGGER_POSTS_URL, params=BLOGGER_INSERT_PARAMS, json=body, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    except (requests.RequestException, GoogleAuthError) as e:
+        # AuthorizedSession refreshes the token itself on a 401, which raises google-auth errors.
+        logger.exception("Blogger insert failed for '%s'", title)
         send_log(f"❌ {source.upper()} ERROR! Failed to post '{title}'.\nError: {e}")
-        if source == 'manual': context.bot.send_message(chat_id=context.user_data['chat_id'], text=f"An error occurred: {e}")
-    finally:
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
+        if chat_id: bot.send_message(chat_id=chat_id, text=f"An error occurred: {e}")
+        return
+    send_log(f"✅ {source.upper()} SUCCESS! Post '{title}' published by {user_name}.")
+    if chat_id: bot.send_message(chat_id=chat_id, text=f"Success! Post '{title}' published.")
+
+def enqueue_publish(**job):
+    future = publish_executor.submit(process_and_publish_post, **job)
+    future.add_done_callback(functools.partial(log_publish_failure, job))
+
+def log_publish_failure(job, future):
+    # process_and_publish_post reports its own errors; this catches anything that escapes it,
+    # so the log channel and the waiting user still hear about the failure.
+    error = future.exception()
+    if error is None:
+        return
+    logger.error("Publish job failed: %s", error, exc_info=error)
+    send_log(f"❌ {job['source'].upper()} ERROR! Failed to post '{job['title']}'.\nError: {error}")
+    if job.get('chat_id'):
+        try: bot.send_message(chat_id=job['chat_id'], text=f"An error occurred: {error}")
+        except TelegramError as e: logger.error("Failed to notify user of publish failure: %s", e)
 
 # --- AUTOMATED CHANNEL POST HANDLER (Original logic, with new domain checker) ---
+# Albums arrive as one update per item sharing a media_group_id, usually with the
+# caption on only one of them; they are collected briefly and published as one post.
+MEDIA_GROUP_WINDOW = 2.0
+media_groups = {}
+media_groups_lock = threading.Lock()
+
 def channel_post_handler(update: Update, context: CallbackContext):
     post = update.channel_post
     if post.chat_id not in SOURCE_CHANNEL_IDS or not (post.photo or post.video):
         return
-    send_log(f"AUTOMATION: Detected new media in channel {post.chat.title} ({post.chat_id}).")
-    if post.video:
-        media_file = post.video.thumb.get_file()
-    else:
-        media_file = post.photo[-1].get_file()
-    full_caption = post.caption or ""
-    
-    # --- MODIFIED: Use the new dynamic domain list instead of hardcoded links ---
-    all_urls = re.findall(r'https?://\S+', full_caption)
-    valid_urls = [url for url in all_urls if any(domain in url for domain in VALID_LINK_DOMAINS)]
-    
+    if post.media_group_id:
+        with media_groups_lock:
+            group = media_groups.setdefault(post.media_group_id, [])
+            group.append(post)
+            first = len(group) == 1
+        if first:
+            threading.Timer(MEDIA_GROUP_WINDOW, flush_media_group, args=(post.media_group_id,)).start()
+        return
+    handle_channel_post(post, post.caption or "")
+
+def flush_media_group(media_group_id):
+    with media_groups_lock:
+        posts = media_groups.pop(media_group_id)
+    caption = "\n".join(p.caption for p in posts if p.caption)
+    # The captioned item's media becomes the post image.
+    lead = next((p for p in posts if p.caption), posts[0])
+    # Runs on a Timer thread, outside the dispatcher's error handler, so failures are reported here.
+    try:
+        handle_channel_post(lead, caption)
+    except Exception as e:
+        logger.exception("Failed to handle album %s", media_group_id)
+        send_log(f"❌ AUTOMATION ERROR! Failed to handle album from {lead.chat.title} ({lead.chat_id}).\nError: {e}")
+
+def handle_channel_post(post, full_caption):
+    # One log line per post (the outcome) instead of a separate "detected" line first.
+    detected = f"AUTOMATION: New media in channel {post.chat.title} ({post.chat_id})."
+    valid_urls, caption_end = [], None
+    for match in CAPTION_RE.finditer(full_caption):
+        if caption_end is None:
+            caption_end = match.start()
+        url = match.group('url')
+        if url and is_allowed_link(url):
+            valid_urls.append(url)
+
     if not valid_urls:
-        send_log(f"AUTOMATION: Post ignored. No links found matching the allowed domains: {', '.join(VALID_LINK_DOMAINS)}")
+        send_log(f"{detected}\nPost ignored. No links found matching the allowed domains: {ALLOWED_DOMAINS_TEXT}")
         return
 
-    # --- Original Caption Parsing Logic ---
-    stop_keywords = ["Full Video", r"\(BY - @", "👉", "Watch Online", r"https?://"]
-    caption_parts = re.split('|'.join(stop_keywords), full_caption, 1, flags=re.IGNORECASE)
-    main_caption = caption_parts[0].strip()
+    main_caption = full_caption[:caption_end].strip()
     if not main_caption:
-        send_log("AUTOMATION: Post ignored. Could not extract a valid caption.")
+        send_log(f"{detected}\nPost ignored. Could not extract a valid caption.")
         return
-    title = main_caption.split('\n')[0].strip()
-    photo_path = f"temp_{media_file.file_id}.jpg"
-    media_file.download(photo_path)
-    process_and_publish_post(context, title, main_caption, photo_path, valid_urls, user_name=f"Channel '{post.chat.title}'", source="automation")
+    title = main_caption.partition('\n')[0].strip()
+    # Everything above works on the caption alone; the media is only touched once the post qualifies.
+    # Videos without a thumbnail are published without an image.
+    media = post.video.thumb if post.video else pick_photo_size(post.photo)
+    enqueue_publish(
+        title=title, caption_text=main_caption, file_id=media and media.file_id, file_unique_id=media and media.file_unique_id, links_list=valid_urls,
+        user_name=f"Channel '{post.chat.title}'", source="automation",
+    )
 
 # --- MANUAL POSTING BOT HANDLERS (Original Code) ---
 GET_TITLE, GET_PHOTO_OR_VIDEO, GET_CAPTION, GET_LINKS = range(4)
@@ -171,13 +528,11 @@ def get_title(update: Update, context: CallbackContext) -> int:
     update.message.reply_text("Title set. Now, please send the photo or video.")
     return GET_PHOTO_OR_VIDEO
 def get_photo_or_video(update: Update, context: CallbackContext) -> int:
-    if update.message.video:
-        media_file = update.message.video.thumb.get_file()
-    else:
-        media_file = update.message.photo[-1].get_file()
-    photo_path = f"temp_{media_file.file_id}.jpg"
-    media_file.download(photo_path)
-    context.user_data['photo_path'] = photo_path
+    # Only the file_id is kept; the image is fetched into memory when the post is published.
+    # Videos without a thumbnail are published without an image.
+    media = update.message.video.thumb if update.message.video else pick_photo_size(update.message.photo)
+    context.user_data['photo_file_id'] = media and media.file_id
+    context.user_data['photo_file_unique_id'] = media and media.file_unique_id
     context.user_data['chat_id'] = update.effective_chat.id
     update.message.reply_text("Media received. Next, send the caption.")
     return GET_CAPTION
@@ -189,11 +544,15 @@ def create_manual_post(update: Update, context: CallbackContext) -> int:
     links_text = update.message.text
     title = context.user_data.get('title', 'No Title')
     caption_text = context.user_data.get('caption', '')
-    photo_path = context.user_data.get('photo_path')
-    valid_urls = re.findall(r'https?://\S+', links_text)
+    photo_file_id = context.user_data.get('photo_file_id')
+    valid_urls = URL_RE.findall(links_text)
     user_name = update.effective_user.first_name
     update.message.reply_text(f"Got it! Publishing '{title}' to your blog...")
-    process_and_publish_post(context, title, caption_text, photo_path, valid_urls, user_name, source="manual")
+    enqueue_publish(
+        title=title, caption_text=caption_text, file_id=photo_file_id,
+        file_unique_id=context.user_data.get('photo_file_unique_id'), links_list=valid_urls,
+        user_name=user_name, source="manual", chat_id=context.user_data.get('chat_id'),
+    )
     return ConversationHandler.END
 def cancel(update: Update, context: CallbackContext) -> int:
     send_log(f"MANUAL: Conversation cancelled by {update.effective_user.first_name}.")
@@ -201,33 +560,48 @@ def cancel(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 # --- NEW: Command Handlers for Domain Management ---
+def is_admin(update: Update) -> bool:
+    return not ADMIN_IDS or update.effective_user.id in ADMIN_IDS
+
 def add_site(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        return
     if not context.args:
         update.message.reply_text("Usage: /addsite <domain.com>")
         return
-    domain_to_add = context.args[0].lower().strip()
+    domain_to_add = normalize_domain(context.args[0])
+    # A bare word like "terabox" can never equal a link's hostname, so it is rejected.
+    if not domain_to_add or '.' not in domain_to_add:
+        update.message.reply_text("Please send a domain name like example.com; links to it and its subdomains will be allowed.")
+        return
     if domain_to_add in VALID_LINK_DOMAINS:
         update.message.reply_text(f"Domain '{domain_to_add}' is already in the list.")
     else:
         VALID_LINK_DOMAINS.add(domain_to_add)
-        save_domains(VALID_LINK_DOMAINS)
+        domains_changed('+', domain_to_add)
         update.message.reply_text(f"Domain '{domain_to_add}' added successfully.")
         send_log(f"ADMIN: Domain added: {domain_to_add} by {update.effective_user.first_name}")
 
 def remove_site(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        return
     if not context.args:
         update.message.reply_text("Usage: /removesite <domain.com>")
         return
     domain_to_remove = context.args[0].lower().strip()
+    if domain_to_remove not in VALID_LINK_DOMAINS:
+        domain_to_remove = normalize_domain(domain_to_remove) or domain_to_remove
     if domain_to_remove in VALID_LINK_DOMAINS:
         VALID_LINK_DOMAINS.discard(domain_to_remove)
-        save_domains(VALID_LINK_DOMAINS)
+        domains_changed('-', domain_to_remove)
         update.message.reply_text(f"Domain '{domain_to_remove}' removed successfully.")
         send_log(f"ADMIN: Domain removed: {domain_to_remove} by {update.effective_user.first_name}")
     else:
         update.message.reply_text(f"Domain '{domain_to_remove}' not found in the list.")
 
 def list_sites(update: Update, context: CallbackContext):
+    if not is_admin(update):
+        return
     if not VALID_LINK_DOMAINS:
         update.message.reply_text("The list of allowed domains is empty.")
     else:
@@ -243,16 +617,109 @@ Hello! Here are the available commands:
 /cancel - Stop the manual posting process.
 /help - Show this message.
 
-/addsite `<domain.com>` - Add a website to the allowed list.
+/addsite `<domain.com>` - Add a website to the allowed list (its subdomains are allowed too).
 /removesite `<domain.com>` - Remove a website from the list.
 /listsites - Show all allowed websites.
 """
     update.message.reply_text(help_text, parse_mode='Markdown')
 
+def error_handler(update: object, context: CallbackContext):
+    # Handlers run on the dispatcher thread after the webhook has already answered 'ok',
+    # so this is the only place their failures surface.
+    logger.error("Error while handling an update: %s", context.error, exc_info=context.error)
+    send_log(f"❌ ERROR while handling an update: {context.error}")
+
+
+# --- CONVERSATION PERSISTENCE (Redis) ---
+class RedisConversations(MutableMapping):
+    """Conversation states stored in Redis, so every worker sees the same state."""
+    def __init__(self, client, name, ttl):
+        self.client, self.prefix, self.ttl = client, f"bot:conv:{name}:", ttl
+
+    def _key(self, key):
+        return self.prefix + json.dumps(key)
+
+    def __getitem__(self, key):
+        state = self.client.get(self._key(key))
+        if state is None:
+            raise KeyError(key)
+        return int(state)
+
+    def __setitem__(self, key, state):
+        self.client.set(self._key(key), state, ex=self.ttl)
+
+    def __delitem__(self, key):
+        if not self.client.delete(self._key(key)):
+            raise KeyError(key)
+
+    def __iter__(self):
+        for redis_key in self.client.scan_iter(self.prefix + "*"):
+            yield tuple(json.loads(redis_key[len(self.prefix):]))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class RedisPersistence(BasePersistence):
+    """Keeps conversation states and user_data in Redis, so a worker restart doesn't
+    drop users mid-conversation and gunicorn workers can scale out. Each key's TTL
+    restarts only when it is written, i.e. when the state or data actually changes;
+    every manual-post step does both, so a session expires SESSION_TTL after its last step."""
+    def __init__(self, client, ttl=SESSION_TTL):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.client = client
+        self.ttl = ttl
+        # Last JSON read from or written to Redis per user. PTB calls update_user_data after
+        # every update, so unchanged data is skipped instead of costing a Redis round-trip.
+        self.stored_user_data = BoundedCache(4096)
+
+    def get_user_data(self):
+        # Loaded lazily per user in refresh_user_data.
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return RedisConversations(self.client, name, self.ttl)
+
+    def update_conversation(self, name, key, new_state):
+        # RedisConversations already writes through on every change.
+        pass
+
+    def refresh_user_data(self, user_id, user_data):
+        raw = self.client.get(f"bot:user:{user_id}")
+        self.stored_user_data.set(user_id, raw)
+        user_data.clear()
+        if raw:
+            user_data.update(json.loads(raw))
+
+    def update_user_data(self, user_id, data):
+        raw = json.dumps(data)
+        if raw == self.stored_user_data.get(user_id):
+            return
+        self.client.set(f"bot:user:{user_id}", raw, ex=self.ttl)
+        self.stored_user_data.set(user_id, raw)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
 
 # --- FLASK WEB SERVER & DISPATCHER SETUP ---
 app = Flask(__name__)
-dispatcher = Dispatcher(bot, None, use_context=True)
+persistence = RedisPersistence(redis_client) if redis_client else None
+# PTB's own update queue: the dispatcher thread takes updates off it in order. Handlers
+# are cheap since publishing is handed to publish_executor.
+update_queue = queue.Queue()
+# No handler uses run_async, so the dispatcher needs no worker pool; PTB warns about
+# that on construction, which is expected here and silenced.
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", message="Asynchronous callbacks can not be processed")
+    dispatcher = Dispatcher(bot, update_queue, workers=0, use_context=True, persistence=persistence)
 
 conv_handler = ConversationHandler(
     entry_points=[CommandHandler('start', start)],
@@ -262,7 +729,7 @@ conv_handler = ConversationHandler(
         GET_CAPTION: [MessageHandler(Filters.text & ~Filters.command, get_caption)],
         GET_LINKS: [MessageHandler(Filters.text & ~Filters.command, create_manual_post)],
     },
-    fallbacks=[CommandHandler('cancel', cancel)], name="manual_blogger_conversation"
+    fallbacks=[CommandHandler('cancel', cancel)], name="manual_blogger_conversation", persistent=persistence is not None
 )
 dispatcher.add_handler(conv_handler)
 dispatcher.add_handler(MessageHandler((Filters.photo | Filters.video) & Filters.chat_type.channel, channel_post_handler))
@@ -272,21 +739,81 @@ dispatcher.add_handler(CommandHandler('addsite', add_site))
 dispatcher.add_handler(CommandHandler('removesite', remove_site))
 dispatcher.add_handler(CommandHandler('listsites', list_sites))
 dispatcher.add_handler(CommandHandler('help', help_command))
+dispatcher.add_error_handler(error_handler)
+
+def run_dispatcher():
+    # Drains update_queue directly rather than through Dispatcher.start(), whose loop
+    # can't be restarted once it has failed; an update that raises is logged and
+    # skipped, so the webhook never keeps acking updates nobody handles.
+    while True:
+        update = update_queue.get()
+        try:
+            dispatcher.process_update(update)
+        except Exception:
+            logger.exception("Failed to process update %s", getattr(update, 'update_id', None))
+
+threading.Thread(target=run_dispatcher, name="dispatcher", daemon=True).start()
+
+# --- DUPLICATE DELIVERY GUARD ---
+# Telegram re-delivers an update when an ack is slow or lost; without this a retry
+# would upload the image and publish the post a second time.
+SEEN_UPDATE_TTL = 3600
+recent_update_ids = BoundedCache(4096)
+
+def is_new_update(update_id) -> bool:
+    if redis_client is not None:
+        # Shared across workers: only the first SET NX for this id succeeds.
+        return bool(redis_client.set(f"bot:seen:{update_id}", 1, nx=True, ex=SEEN_UPDATE_TTL))
+    return recent_update_ids.add(update_id)
 
+# Telegram gets its ack as soon as the update is queued, instead of waiting for ImageBB and Blogger.
 @app.route('/' + TELEGRAM_TOKEN, methods=['POST'])
 def webhook():
-    update = Update.de_json(request.get_json(force=True), bot)
-    dispatcher.process_update(update)
+    update = Update.de_json(orjson.loads(request.get_data(cache=False)), bot)
+    if is_new_update(update.update_id):
+        update_queue.put(update)
     return 'ok'
 
 @app.route('/')
 def index():
     return 'Bot is running!'
 
+# Only the update types the handlers use; Telegram filters the rest out server-side.
+ALLOWED_UPDATES = ["message", "channel_post"]
+
+def register_webhook():
+    # Run once per deploy (e.g. `python -c "import poster_bot; poster_bot.register_webhook()"`);
+    # Telegram keeps the webhook across restarts, so it is only re-set when the URL changed.
+    url = f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
+    info = bot.get_webhook_info()
+    if info.url != url or info.allowed_updates != ALLOWED_UPDATES or info.max_connections != WEBHOOK_MAX_CONNECTIONS:
+        bot.set_webhook(url=url, allowed_updates=ALLOWED_UPDATES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info("Webhook set to %s", WEBHOOK_URL)
+
+def poll_updates():
+    # Local development without a public URL: long-poll getUpdates into the same queue
+    # the webhook feeds, so the handlers behave exactly as in production.
+    if bot.get_webhook_info().url:
+        if not DELETE_WEBHOOK_FOR_POLLING:
+            # Likely the production bot: polling would silently unregister its webhook.
+            raise SystemExit("A webhook is registered for this bot; set DELETE_WEBHOOK_FOR_POLLING=1 to remove it and poll.")
+        bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            for update in bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES):
+                offset = update.update_id + 1
+                update_queue.put(update)
+        except Exception as e:
+            logger.error("Polling failed: %s", e)
+            time.sleep(5)
+
 if __name__ == "__main__":
+    # Local development only; deployments run under gunicorn (see Procfile / render.yaml).
     if WEBHOOK_URL:
-        bot.set_webhook(url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}")
-        logger.info(f"Webhook set to {WEBHOOK_URL}")
+        if SET_WEBHOOK_ON_START:
+            register_webhook()
         send_log("🚀 Bot has been deployed/restarted with dynamic domain features.")
-    port = int(os.environ.get('PORT', 8000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+        app.run(host='0.0.0.0', port=PORT)
+    else:
+        poll_updates()
\ No newline at end of file